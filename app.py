@@ -4,14 +4,55 @@ Optimized for Real-Time Data, Movies, and Sequential Planning.
 """
 
 import os
-import json
 import re
+import sys
+import logging
+import copy
+import time
+import hashlib
+import threading
+from concurrent.futures import Future
 from datetime import datetime, timedelta
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
+import orjson
+
+class ORJSONProvider(DefaultJSONProvider):
+    """request.json / jsonify() through orjson: bytes straight in and out, no str round trip."""
+    
+    def _orjson_option(self):
+        return orjson.OPT_SORT_KEYS if self.sort_keys else 0
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._orjson_option()).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self._orjson_option())
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+# LOG_LEVEL=WARNING in production drops per-request lines to a single level check.
+# An unknown name falls back to INFO rather than failing every worker's import.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+_log_level_known = isinstance(logging.getLevelName(LOG_LEVEL), int)
+
+# Records go to stdout, where the old print() output went
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+logger = logging.getLogger("travel_buddy")
+logger.setLevel(LOG_LEVEL if _log_level_known else logging.INFO)
+logger.addHandler(_log_stream)
+if not _log_level_known:
+    logger.warning("⚠️ Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 # CORS setup is crucial for Shopify to talk to Render
 CORS(app, resources={r"/api/*": {
     "origins": "*",
@@ -25,6 +66,72 @@ GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 # Endpoint for Gemini 2.0 Flash
 GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
 
+# Key as a header, passed per Gemini call: the URL stays constant (and out of logs),
+# and the shared session never carries the key to other hosts
+GEMINI_HEADERS = {"x-goog-api-key": GEMINI_API_KEY}
+
+# (connect, read) seconds: fail fast on an unreachable host, allow a full grounded generation
+GEMINI_TIMEOUT = (5, 60)
+
+# Shared HTTP session: keep-alive reuses the TLS connection to Google across requests
+HTTP_POOL_SIZE = 100  # matches worker_connections in gunicorn.conf.py
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+http_session.headers.update({"Content-Type": "application/json"})
+
+# Substrings that mark a movie query (substring match so "movies"/"films" still hit)
+MOVIE_KEYWORDS = ('movie', 'film', 'show', 'cinema', 'watch')
+
+# Error bodies can be large HTML/JSON pages; log only the head
+LOG_BODY_LIMIT = 256
+
+# Markdown code fence wrapped around a reply (```json ... ```)
+FENCE_RE = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$')
+
+# Response cache: an identical prompt (same query, context and minute) reuses the last plan.
+# The key changes every minute anyway; a longer TTL would only serve stale "open now" plans.
+GEMINI_CACHE_TTL = 60  # seconds
+GEMINI_CACHE_MAX = 256
+_gemini_cache = {}  # sha256(prompt) -> (expires_at, result)
+_gemini_cache_lock = threading.Lock()
+_gemini_inflight = {}  # sha256(prompt) -> Future of the call already running (same lock)
+
+# ==========================================
+# RESPONSE CACHE & IN-FLIGHT DEDUP
+# ==========================================
+
+def cache_get(key: str):
+    """Returns a copy of a fresh cached result, or None."""
+    with _gemini_cache_lock:
+        entry = _gemini_cache.get(key)
+        if not entry:
+            return None
+        if entry[0] < time.time():
+            del _gemini_cache[key]
+            return None
+        return copy.deepcopy(entry[1])
+
+def cache_put(key: str, result: dict):
+    """Stores a parsed result, evicting the oldest entry when full."""
+    with _gemini_cache_lock:
+        if key not in _gemini_cache and len(_gemini_cache) >= GEMINI_CACHE_MAX:
+            del _gemini_cache[next(iter(_gemini_cache))]
+        _gemini_cache[key] = (time.time() + GEMINI_CACHE_TTL, copy.deepcopy(result))
+
+def inflight_join(key: str):
+    """Returns (future, is_leader); only the leader calls Gemini for this prompt."""
+    with _gemini_cache_lock:
+        future = _gemini_inflight.get(key)
+        if future is not None:
+            return future, False
+        future = _gemini_inflight[key] = Future()
+        return future, True
+
+def inflight_leave(key: str):
+    """Frees the slot once the leader is done, so later calls go to cache or Gemini."""
+    with _gemini_cache_lock:
+        _gemini_inflight.pop(key, None)
+
 # ==========================================
 # THE "LOGISTICS ENGINE" PROMPT
 # ==========================================
@@ -95,30 +202,79 @@ JSON SCHEMA FOR "itinerary" (Simple list):
 }
 """
 
+# Everything in the Gemini request body except "contents" is fixed: encode it once
+GEMINI_STATIC_BODY = orjson.dumps({
+    "systemInstruction": {"parts": [{"text": SYSTEM_PROMPT}]},
+    "tools": [{"google_search": {}}], # Enable Grounding
+    "generationConfig": {
+        "temperature": 0.7,
+        "maxOutputTokens": 4096,
+        "responseMimeType": "application/json" # Force JSON output mode
+    }
+})
+
+def build_gemini_body(prompt: str) -> bytes:
+    """Splices the per-request contents into the pre-encoded static body."""
+    contents = orjson.dumps([{"role": "user", "parts": [{"text": prompt}]}])
+    return b'{"contents":' + contents + b',' + GEMINI_STATIC_BODY[1:]
+
+def parse_model_json(text: str):
+    """Parses the model's reply; returns None if no JSON object can be recovered."""
+    # JSON mode (responseMimeType) normally returns the object bare: one parse, no scans
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    # Sometimes response adds markdown, strip it
+    try:
+        return orjson.loads(FENCE_RE.sub('', text))
+    except orjson.JSONDecodeError:
+        pass
+    # Prose around the JSON: take the outermost {...} block (one slice, no regex)
+    start, end = text.find('{'), text.rfind('}')
+    if start != -1 and end > start:
+        try:
+            return orjson.loads(text[start:end + 1])
+        except orjson.JSONDecodeError:
+            pass
+    return None
+
+def is_valid_plan(plan) -> bool:
+    """Shape check: an object carrying the list the widget renders (timeline or cards)."""
+    if not isinstance(plan, dict):
+        return False
+    items = plan.get('timeline') if plan.get('type') == 'day_plan' else plan.get('cards')
+    return isinstance(items, list)
+
+def compact_preferences(preferences) -> dict:
+    """Drops unset wizard fields so they don't cost prompt tokens."""
+    if not isinstance(preferences, dict):
+        return {}
+    return {k: v for k, v in preferences.items() if v not in (None, '', [], {})}
+
 def call_gemini(user_query: str, context: dict, preferences: dict) -> dict:
     """Calls Gemini with forced Search Grounding."""
     
     if not GEMINI_API_KEY:
         return {"error": "GEMINI_API_KEY not configured"}
     
-    # 1. Prepare Context
+    # 1. Prepare Context (read the clock once per request)
+    now = datetime.now()
     location = context.get('location') or 'Unknown'
     coords = context.get('coordinates') or {}
-    local_time = context.get('local_time') or datetime.now().strftime('%H:%M')
-    local_hour = context.get('local_hour') or datetime.now().hour
+    local_time = context.get('local_time') or now.strftime('%H:%M')
+    local_hour = context.get('local_hour') or now.hour
     timezone = context.get('timezone') or 'Asia/Kolkata'
     
     # Format Coordinates for readability
     coord_str = f"{coords.get('lat', 'N/A')}, {coords.get('lng', 'N/A')}"
     
     # 2. Date Logic (Crucial for Movies)
-    today = datetime.now()
-    tomorrow = today + timedelta(days=1)
-    date_str = today.strftime('%A, %B %d')
-    tomorrow_str = tomorrow.strftime('%A, %B %d')
+    date_str = now.strftime('%A, %B %d')
 
     # 3. Detect Intent (Movie vs General)
-    is_movie_intent = any(kw in user_query.lower() for kw in ['movie', 'film', 'show', 'cinema', 'watch'])
+    query_lower = user_query.lower()
+    is_movie_intent = any(kw in query_lower for kw in MOVIE_KEYWORDS)
     
     # 4. Inject Specific Instructions for Movies
     search_hint = ""
@@ -127,9 +283,11 @@ def call_gemini(user_query: str, context: dict, preferences: dict) -> dict:
         if local_hour < 18: # Before 6 PM, assume today
             search_hint = f"CRITICAL: Search for 'Movies showing in {location} today ({date_str})'. Find specific showtimes."
         else:
+            tomorrow_str = (now + timedelta(days=1)).strftime('%A, %B %d')
             search_hint = f"CRITICAL: Search for 'Movies showing in {location} tomorrow ({tomorrow_str})' as it is late."
     
     # 5. Build the Final Context String
+    prefs_json = orjson.dumps(compact_preferences(preferences)).decode('utf-8')
     context_block = f"""
 USER CONTEXT:
 - Location: {location}
@@ -137,7 +295,7 @@ USER CONTEXT:
 - Current Time: {local_time}
 - Timezone: {timezone}
 - Date: {date_str}
-- Preferences: {json.dumps(preferences)}
+- Preferences: {prefs_json}
 
 USER REQUEST: {user_query}
 
@@ -146,57 +304,68 @@ USER REQUEST: {user_query}
 Use Google Search to find REAL information. If querying locations, use the coordinates to find the NEAREST options.
 """
 
+    # Same prompt within the TTL -> skip the Gemini round trip
+    cache_key = hashlib.sha256(context_block.encode('utf-8')).hexdigest()
+    cached = cache_get(cache_key)
+    if cached is not None:
+        logger.debug("⚡ Cache hit")
+        return cached
+
+    # Same prompt already being generated (double-submit, retry) -> share that call
+    future, is_leader = inflight_join(cache_key)
+    if not is_leader:
+        logger.debug("⏳ Joined in-flight request")
+        return copy.deepcopy(future.result())
+    
+    try:
+        result = fetch_plan(context_block, cache_key, user_query, location)
+        future.set_result(copy.deepcopy(result))
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        inflight_leave(cache_key)
+
+def fetch_plan(context_block: str, cache_key: str, user_query: str, location: str) -> dict:
+    """One generateContent round trip; caches the parsed plan, falls back on any failure."""
+    
     # 6. API Payload
-    payload = {
-        "contents": [{"role": "user", "parts": [{"text": context_block}]}],
-        "systemInstruction": {"parts": [{"text": SYSTEM_PROMPT}]},
-        "tools": [{"google_search": {}}], # Enable Grounding
-        "generationConfig": {
-            "temperature": 0.7,
-            "maxOutputTokens": 4096,
-            "responseMimeType": "application/json" # Force JSON output mode
-        }
-    }
+    body = build_gemini_body(context_block)
     
     try:
-        response = requests.post(
-            f"{GEMINI_URL}?key={GEMINI_API_KEY}",
-            headers={"Content-Type": "application/json"},
-            json=payload,
-            timeout=60
+        response = http_session.post(
+            GEMINI_URL,
+            headers=GEMINI_HEADERS,
+            data=body,
+            timeout=GEMINI_TIMEOUT
         )
         
         if response.status_code != 200:
-            print(f"❌ Gemini Error: {response.status_code} - {response.text}")
+            logger.error("❌ Gemini Error: %s - %s", response.status_code, response.content[:LOG_BODY_LIMIT].decode('utf-8', errors='replace'))
             return create_fallback_response(user_query, location)
         
-        result = response.json()
+        # Parse the raw bytes once (skips requests' charset sniffing + stdlib json)
+        result = orjson.loads(response.content)
         
         # Deep extraction of text
         try:
             text = result['candidates'][0]['content']['parts'][0]['text']
         except (KeyError, IndexError):
-            print("❌ Invalid response structure from Gemini")
+            logger.error("❌ Invalid response structure from Gemini")
             return create_fallback_response(user_query, location)
 
-        # Parse JSON
-        try:
-            # Sometimes response adds markdown, strip it
-            text = text.replace('```json', '').replace('```', '').strip()
-            return json.loads(text)
-        except json.JSONDecodeError:
-            # Fallback regex parsing (robust)
-            match = re.search(r'\{.*\}', text, re.DOTALL)
-            if match:
-                return json.loads(match.group(0))
-            else:
-                print("❌ Could not parse JSON from response")
-                return create_fallback_response(user_query, location)
+        # Parse JSON (a reply without a renderable plan is as bad as no JSON, and is never cached)
+        parsed = parse_model_json(text)
+        if not is_valid_plan(parsed):
+            logger.error("❌ Could not parse a plan from response")
+            return create_fallback_response(user_query, location)
+
+        cache_put(cache_key, parsed)
+        return parsed
 
     except Exception as e:
-        print(f"❌ Server Error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Server Error: %s", e)
         return create_fallback_response(user_query, location)
 
 def create_fallback_response(query: str, location: str) -> dict:
@@ -221,22 +390,59 @@ def create_fallback_response(query: str, location: str) -> dict:
         "closing": "Please try again in a moment!"
     }
 
+def warm_gemini_connection():
+    """Opens a pooled connection to Gemini so the first user request skips DNS + TLS."""
+    if not GEMINI_API_KEY:
+        return
+    try:
+        # Model metadata GET: same host as GEMINI_URL, no tokens billed
+        http_session.get(GEMINI_URL.rsplit(':', 1)[0], headers=GEMINI_HEADERS, timeout=GEMINI_TIMEOUT)
+    except requests.RequestException as e:
+        logger.warning("⚠️ Gemini warm-up failed: %s", e)
+
 # ==========================================
 # ROUTES
 # ==========================================
 
+def is_valid_assist_body(data) -> bool:
+    """Shape check: query is text, context and preferences are objects (or absent),
+    and the context fields call_gemini reads into have the types it expects."""
+    if not isinstance(data, dict):
+        return False
+    context = data.get('context')
+    preferences = data.get('preferences')
+    if not (isinstance(data.get('query', ''), str)
+            and (context is None or isinstance(context, dict))
+            and (preferences is None or isinstance(preferences, dict))):
+        return False
+    context = context or {}
+    local_hour = context.get('local_hour')
+    return (isinstance(context.get('coordinates') or {}, dict)
+            and (local_hour is None
+                 or (isinstance(local_hour, int) and not isinstance(local_hour, bool))))
+
 @app.route('/api/assist', methods=['POST', 'OPTIONS'])
 def assist():
     if request.method == 'OPTIONS':
         return '', 204 # CORS Preflight
     
     try:
-        data = request.json or {}
+        # None = undecodable body or non-JSON content type: malformed, not an empty query
+        data = request.get_json(silent=True)
+        
+        # Malformed body -> 400 right away, before any external API is touched
+        if not is_valid_assist_body(data):
+            return jsonify({"type": "error", "greeting": "That request didn't look right."}), 400
+        
         query = data.get('query', '')
-        context = data.get('context', {})
-        preferences = data.get('preferences', {})
+        context = data.get('context') or {}
+        preferences = data.get('preferences') or {}
         
-        print(f"📥 Incoming Query: {query}")
+        logger.info("📥 Incoming Query: %s", query)
+        
+        # Nothing to plan -> don't spend a Gemini call on it
+        if not query.strip():
+            return jsonify({"type": "error", "greeting": "Tell me what you're in the mood for!"}), 400
         
         result = call_gemini(query, context, preferences)
         
@@ -247,12 +453,16 @@ def assist():
         return jsonify(result)
         
     except Exception as e:
-        print(f"❌ API Route Error: {e}")
+        logger.error("❌ API Route Error: %s", e)
         return jsonify({"type": "error", "greeting": "Something went wrong."}), 500
 
+# Static health body, encoded once (liveness probes hit this constantly)
+HEALTH_BODY = orjson.dumps({"status": "ok", "service": "Travel Buddy V3"})
+
 @app.route('/api/health', methods=['GET'])
 def health():
-    return jsonify({"status": "ok", "service": "Travel Buddy V3"})
+    # Fresh Response per probe: flask-cors adds headers to it, so it can't be shared
+    return app.response_class(HEALTH_BODY, mimetype='application/json')
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,20 @@
+# Gunicorn settings (picked up automatically from the working directory)
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+
+# Requests spend seconds waiting on Gemini: gevent lets one worker hold many of them
+worker_class = "gevent"
+worker_connections = 100  # keep in step with HTTP_POOL_SIZE in app.py
+timeout = 120
+
+# Let the Render proxy reuse connections instead of reconnecting per request
+keepalive = 30
+
+def post_worker_init(worker):
+    # Each worker, once the app is loaded: open the pooled Gemini connection in the
+    # background so serving isn't held up (importing app alone never calls out)
+    import threading
+    from app import warm_gemini_connection
+    threading.Thread(target=warm_gemini_connection, daemon=True).start()